@@ -1,13 +1,16 @@
+from django.core.exceptions import FieldDoesNotExist
 from django.db import models
 
 from collections import defaultdict
 from datetime import datetime
+from functools import lru_cache
 from typing import Callable, Any
 
 
 __all__ = (
     "SerializableModel",
-    "SerializableField"
+    "SerializableField",
+    "prepare_queryset"
 )
 
 
@@ -79,84 +82,159 @@ def _separate_field_args(fields: list[str | SerializableField | None], only_incl
     return now, later
 
 
-class SerializableModel(models.Model):
-    class Meta:
-        abstract = True
+# how the value of a field is serialized
+_VALUE = 0  # as is, serializing nested models and datetimes
+_RELATED = 1  # a serializable model through a forward or one-to-one relation
+_MANAGER = 2  # every object of a reverse or many-to-many relation
 
-    class Serialization:
-        FIELDS: list
-        EXCLUDES: list
-        TRANSFORM: dict[str, str]
 
-    def _transform(
-        self,
-        fields: list[SerializableField],
-        excludes: dict[SerializableField, list[SerializableField]],
-        includes: dict[SerializableField, list[SerializableField]]
-    ) -> dict | None:
-        field_transforms = getattr(self.Serialization, "TRANSFORM", {})
+class _SerializationPlan:
+    """Fields to serialize for a model and how, worked out once for a combination of includes and excludes"""
 
-        data = {}
-        for field in fields:
-            str_field = str(field)
+    __slots__ = ("steps",)
 
+    def __init__(self, steps: list[tuple]):
+        # (attribute, key, kind, condition, filter, post serial filter, child includes, child excludes)
+        self.steps = steps
+
+    def run(self, obj) -> dict:
+        data = {}
+        for attr, key, kind, condition, serialize_filter, post_serial_filter, includes, excludes in self.steps:
             # conditional inclusion
-            serialize_condition = getattr(field, "serialize_condition", None)
-            if serialize_condition is not None and not serialize_condition(self):
+            if condition is not None and not condition(obj):
                 continue
 
-            # filter iterative values
-            serialize_filter = getattr(field, "serialize_filter", None)
-            post_serial_filter = getattr(field, "post_serial_filter", None)
-
-            value = getattr(self, str_field)
-            if isinstance(value, SerializableModel):
-                value = value.serialize(includes.get(field), excludes.get(field))
+            value = getattr(obj, attr)
+            if kind == _RELATED:
+                if value is not None:
+                    value = _get_plan(value.__class__, includes, excludes).run(value)
+            elif kind == _MANAGER:
+                # filter iterative values
+                plan = _get_plan(value.model, includes, excludes)
+                value = [
+                    plan.run(child) for child in value.all()
+                    if serialize_filter is None or serialize_filter(child)
+                ]
+            elif isinstance(value, SerializableModel):
+                value = value.serialize(_from_key(includes), _from_key(excludes))
             elif isinstance(value, datetime):
                 value = value.isoformat()
-            elif value.__class__.__name__ == "RelatedManager":
-                serialize_filter = serialize_filter or (lambda a: True)
-                value = (
-                    obj.serialize(includes.get(field), excludes.get(field))
-                    for obj in value.all() if serialize_filter(obj)
-                )
 
             if post_serial_filter is not None and hasattr(value, "__iter__"):
-                value = filter(post_serial_filter, value)
+                value = list(filter(post_serial_filter, value))
 
-            if hasattr(value, "__next__"):
-                value = list(value)
+            data[key] = value
+        return data
 
-            data[field_transforms.get(str_field, str_field)] = value
 
-        return data
+def _to_key(fields) -> tuple:
+    """hashable form of includes or excludes, keeping the callables of SerializableFields apart"""
+    if not fields:
+        return ()
+    return tuple(
+        (field.field, field.serialize_condition, field.serialize_filter, field.post_serial_filter)
+        if isinstance(field, SerializableField) else field
+        for field in fields
+    )
+
+
+def _from_key(key: tuple) -> list[str | SerializableField]:
+    return [SerializableField(*field) if isinstance(field, tuple) else field for field in key]
+
+
+@lru_cache(maxsize=1024)
+def _get_plan(cls, includes: tuple, excludes: tuple) -> _SerializationPlan:
+    exclude_now, exclude_later = _separate_field_args(_from_key(excludes), only_include_last=True)
+    include_now, include_later = _separate_field_args(_from_key(includes))
+
+    fields = list(map(SerializableField, cls.Serialization.FIELDS))
+    for field in exclude_now:
+        fields.remove(field)
+    for field in include_now:
+        # replace field instead of adding new one
+        try:
+            i = fields.index(field)
+            if not field.is_passive:
+                fields[i] = field
+            continue
+        except ValueError:
+            pass
+
+        fields.append(field)
+
+    field_transforms = getattr(cls.Serialization, "TRANSFORM", {})
+    steps = []
+    for field in fields:
+        str_field = str(field)
+        kind = _VALUE
+        try:
+            model_field = cls._meta.get_field(str_field)
+        except FieldDoesNotExist:
+            pass
+        else:
+            if model_field.one_to_many or model_field.many_to_many:
+                kind = _MANAGER
+            elif model_field.is_relation and issubclass(model_field.related_model, SerializableModel):
+                kind = _RELATED
+        steps.append((
+            str_field,
+            field_transforms.get(str_field, str_field),
+            kind,
+            field.serialize_condition,
+            field.serialize_filter,
+            field.post_serial_filter,
+            _to_key(include_later.get(field)),
+            _to_key(exclude_later.get(field)),
+        ))
+    return _SerializationPlan(steps)
+
+
+class SerializableModel(models.Model):
+    class Meta:
+        abstract = True
+
+    class Serialization:
+        FIELDS: list
+        EXCLUDES: list
+        TRANSFORM: dict[str, str]
 
     def serialize(
         self,
         includes: list[str | SerializableField] | None = None,
         excludes: list[str] | None = None
     ) -> dict | None:
-        if includes is None:
-            includes = []
-        if excludes is None:
-            excludes = []
-
-        exclude_now, exclude_later = _separate_field_args(excludes, only_include_last=True)
-        include_now, include_later = _separate_field_args(includes)
-
-        fields = list(map(SerializableField, self.Serialization.FIELDS))
-        for field in exclude_now:
-            fields.remove(field)
-        for field in include_now:
-            # replace field instead of adding new one
-            try:
-                i = fields.index(field)
-                if not field.is_passive:
-                    fields[i] = field
-                continue
-            except ValueError:
-                pass
+        # the plan for these arguments is only worked out the first time they're used with this model
+        return _get_plan(self.__class__, _to_key(includes), _to_key(excludes)).run(self)
+
+
+def _relation_paths(cls, includes: tuple, excludes: tuple, prefix: str, in_prefetch: bool, selects, prefetches):
+    for attr, _, kind, _, _, _, child_includes, child_excludes in _get_plan(cls, includes, excludes).steps:
+        if kind == _VALUE:
+            continue
+        path = prefix + attr
+        # a relation can only be joined in if everything before it was too
+        child_in_prefetch = in_prefetch or kind == _MANAGER
+        (prefetches if child_in_prefetch else selects).append(path)
+        _relation_paths(
+            cls._meta.get_field(attr).related_model, child_includes, child_excludes,
+            path + "__", child_in_prefetch, selects, prefetches
+        )
 
-            fields.append(field)
 
-        return self._transform(fields, exclude_later, include_later)
\ No newline at end of file
+def prepare_queryset(
+    queryset: models.QuerySet,
+    includes: list[str | SerializableField] | None = None,
+    excludes: list[str] | None = None
+) -> models.QuerySet:
+    """
+    joins and prefetches every relation that serializing the queryset's objects
+    with these includes and excludes goes through, so it takes a constant number of queries
+    """
+    selects = []
+    prefetches = []
+    _relation_paths(queryset.model, _to_key(includes), _to_key(excludes), "", False, selects, prefetches)
+    if selects:
+        queryset = queryset.select_related(*selects)
+    if prefetches:
+        queryset = queryset.prefetch_related(*prefetches)
+    return queryset
@@ -5,6 +5,7 @@ from django.conf import settings
 
 from common.views import render
 from common.constants import AUTH_BACKEND
+from common.serializer import prepare_queryset
 from .models import UserOsuConnection, UserOsuData, UserChannel, UserChannelConnection
 
 from sesame.utils import get_token as _get_token
@@ -52,14 +53,16 @@ def dashboard(req):
 
 @requires_login
 def channel_dashboard(req, id: int):
-    channel = UserChannel.objects.prefetch_related("commands__command", "managers").select_related("user").filter(id=id).first()
+    includes = ["user", "commands__command"]
+    # managers aren't serialized, but are read for the permission check and managers_string
+    channel = prepare_queryset(UserChannel.objects.prefetch_related("managers__user"), includes).filter(id=id).first()
     if channel is None:
         return redirect("dashboard")
 
     if not channel.can_access_settings(req.user):
         return HttpResponseForbidden()
 
-    serial_channel = channel.serialize(includes=["user", "commands__command"])
+    serial_channel = channel.serialize(includes=includes)
     serial_channel["commands"] = sorted(serial_channel["commands"], key=lambda c: c["command"]["name"])
     serial_channel["managers_string"] = ", ".join((conn.user.username for conn in channel.managers.all()))
 
@@ -0,0 +1,279 @@
+from django.db import connection
+
+from .models import CanvasCheckpoint, User
+
+from time import time
+from math import prod
+import threading
+import zlib
+
+import numpy as np
+
+
+__all__ = (
+    "CANVAS_WIDTH",
+    "CANVAS_HEIGHT",
+    "TILE_SIZE",
+    "TILE_COLUMNS",
+    "TILE_ROWS",
+    "COLOR_COUNT",
+    "CanvasState",
+    "save_checkpoint",
+    "map_shared_arrays",
+)
+
+
+CANVAS_WIDTH = 750
+CANVAS_HEIGHT = 750
+
+TILE_SIZE = 50
+TILE_COLUMNS = CANVAS_WIDTH // TILE_SIZE
+TILE_ROWS = CANVAS_HEIGHT // TILE_SIZE
+
+COLOR_COUNT = 40
+
+# rows fetched and applied at a time when rebuilding from the database
+LOAD_CHUNK_SIZE = 50000
+
+# older checkpoints are deleted once a new one is saved
+CHECKPOINTS_KEPT = 2
+
+
+def save_checkpoint(placement_id, pixels, owners, timestamps, user_ids):
+    """saves a snapshot of the canvas that includes every placement up to placement_id"""
+    CanvasCheckpoint.objects.create(
+        placement_id=placement_id,
+        timestamp=time(),
+        pixels=zlib.compress(pixels.tobytes()),
+        owners=zlib.compress(owners.astype("<i4").tobytes()),
+        timestamps=zlib.compress(timestamps.astype("<f8").tobytes()),
+        user_ids=zlib.compress(user_ids.astype("<i8").tobytes()),
+    )
+    old = CanvasCheckpoint.objects.order_by("-placement_id").values_list("id", flat=True)[CHECKPOINTS_KEPT:]
+    CanvasCheckpoint.objects.filter(id__in=list(old)).delete()
+
+
+# arrays in a shared canvas file, in order. readers get the users that owner indices refer to separately
+SHARED_LAYOUT = (
+    ("timestamps", np.float64, (CANVAS_HEIGHT, CANVAS_WIDTH)),
+    ("owners", np.int32, (CANVAS_HEIGHT, CANVAS_WIDTH)),
+    ("pixels", np.uint8, (CANVAS_HEIGHT, CANVAS_WIDTH)),
+)
+
+
+def map_shared_arrays(path, writable) -> dict[str, np.ndarray]:
+    """
+    maps the canvas arrays onto the file at path, which is created (or emptied) when writable.
+    only one process should map it writable, any number can map it read only
+    """
+    size = sum(np.dtype(dtype).itemsize*prod(shape) for _, dtype, shape in SHARED_LAYOUT)
+    memory = np.memmap(path, np.uint8, "w+" if writable else "r", shape=(size,))
+    arrays = {}
+    offset = 0
+    for name, dtype, shape in SHARED_LAYOUT:
+        length = np.dtype(dtype).itemsize*prod(shape)
+        arrays[name] = memory[offset:offset+length].view(dtype).reshape(shape)
+        offset += length
+    return arrays
+
+
+class CanvasState:
+    """
+    Colors, owners and last placement time of every pixel on the canvas, kept in memory.
+    With a shared_path the arrays live in a memory-mapped file instead, written by the one
+    writable state and read by read only states in other processes
+    """
+
+    def __init__(self, shared_path=None, writable=True):
+        self.lock: threading.Lock = threading.Lock()
+        self.writable = writable
+
+        # indexed [y, x]. owners holds an index into users for each pixel, 0 meaning no owner
+        if shared_path is None:
+            self.pixels = np.zeros((CANVAS_HEIGHT, CANVAS_WIDTH), np.uint8)
+            self.owners = np.zeros((CANVAS_HEIGHT, CANVAS_WIDTH), np.int32)
+            self.timestamps = np.zeros((CANVAS_HEIGHT, CANVAS_WIDTH), np.float64)
+            self.shared = None
+        else:
+            self.shared = map_shared_arrays(shared_path, writable)
+            self.pixels = self.shared["pixels"]
+            self.owners = self.shared["owners"]
+            self.timestamps = self.shared["timestamps"]
+        self.users = [""]
+        self.user_indices = {}
+
+        # id of the newest placement applied, overall and for each tile
+        self.version = 0
+        self.tile_versions = np.zeros((TILE_ROWS, TILE_COLUMNS), np.int64)
+        self.tile_cache = {}
+        self.last_sync = 0
+
+    def load(self):
+        """loads the latest checkpoint and replays the placements made after it"""
+        with self.lock:
+            checkpoint = CanvasCheckpoint.objects.order_by("-placement_id").first()
+            start = 0
+            if checkpoint is not None:
+                self._load_checkpoint(checkpoint)
+                start = checkpoint.placement_id
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT MAX(id) FROM place_placement")
+                self.version = max(cursor.fetchone()[0] or 0, start)
+            # server-side cursor, so the newest placement of each pixel is streamed in chunks
+            with connection.chunked_cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT DISTINCT ON (x, y) id, x, y, color, timestamp, user_id
+                    FROM place_placement
+                    WHERE id > %s AND id <= %s
+                    ORDER BY x, y, timestamp DESC
+                    """,
+                    [start, self.version]
+                )
+                while placements := cursor.fetchmany(LOAD_CHUNK_SIZE):
+                    self._apply_rows(placements)
+            self.last_sync = time()
+
+    def sync(self, min_interval=0):
+        """applies placements made since the last load or sync"""
+        if time() - self.last_sync < min_interval:
+            return
+
+        with self.lock:
+            # another thread may have synced while this one waited
+            if time() - self.last_sync < min_interval:
+                return
+            # streamed in chunks, there can be a lot of them after a quiet spell for this process
+            with connection.chunked_cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT id, x, y, color, timestamp, user_id
+                    FROM place_placement
+                    WHERE id > %s
+                    ORDER BY id
+                    """,
+                    [self.version]
+                )
+                while placements := cursor.fetchmany(LOAD_CHUNK_SIZE):
+                    self._apply_rows(placements)
+            self.last_sync = time()
+
+    def get_tile(self, x, y) -> tuple[int, bytes]:
+        """returns the version and compressed pixels of a tile"""
+        with self.lock:
+            version = int(self.tile_versions[y, x])
+            tile = self.tile_cache.get((x, y))
+            if tile is None or tile[0] != version:
+                pixels = self.pixels[y*TILE_SIZE:(y+1)*TILE_SIZE, x*TILE_SIZE:(x+1)*TILE_SIZE]
+                tile = self.tile_cache[(x, y)] = (version, zlib.compress(pixels.tobytes()))
+        return tile
+
+    def get_color_counts(self) -> np.ndarray:
+        """number of pixels of each color"""
+        return np.bincount(self.pixels.ravel(), minlength=COLOR_COUNT)
+
+    def get_owner_counts(self) -> dict[str, int]:
+        """number of pixels currently owned by each user"""
+        counts = np.bincount(self.owners.ravel(), minlength=len(self.users))
+        return {self.users[i]: int(counts[i]) for i in np.flatnonzero(counts[1:]) + 1}
+
+    # These expect the lock to be held
+
+    def _load_checkpoint(self, checkpoint):
+        # assigned in place, since the arrays may be mapped onto a shared file
+        shape = (CANVAS_HEIGHT, CANVAS_WIDTH)
+        self.pixels[:] = np.frombuffer(zlib.decompress(checkpoint.pixels), np.uint8).reshape(shape)
+        self.owners[:] = np.frombuffer(zlib.decompress(checkpoint.owners), "<i4").reshape(shape)
+        self.timestamps[:] = np.frombuffer(zlib.decompress(checkpoint.timestamps), "<f8").reshape(shape)
+        user_ids = np.frombuffer(zlib.decompress(checkpoint.user_ids), "<i8").tolist()
+        names = dict(User.objects.filter(id__in=user_ids[1:]).values_list("id", "username"))
+        self.users = [""]
+        self.user_indices = {}
+        for user_id in user_ids[1:]:
+            self._get_user_index(user_id, names.get(user_id, ""))
+        self.tile_versions[:] = checkpoint.placement_id
+        self.version = checkpoint.placement_id
+
+    def _snapshot(self):
+        """copies of the canvas arrays and the user id of each owner index, for save_checkpoint"""
+        user_ids = np.zeros(len(self.users), np.int64)
+        for user_id, i in self.user_indices.items():
+            user_ids[i] = user_id
+        return self.pixels.copy(), self.owners.copy(), self.timestamps.copy(), user_ids
+
+    def _apply_rows(self, rows):
+        """applies (id, x, y, color, timestamp, user_id) rows, oldest first"""
+        # every column fits losslessly in a float64, a null user_id becoming nan
+        columns = np.array(rows, np.float64)
+        self._apply_placements(
+            columns[:, 0].astype(np.int64),
+            columns[:, 1].astype(np.int64),
+            columns[:, 2].astype(np.int64),
+            columns[:, 3].astype(np.uint8),
+            columns[:, 4],
+            np.nan_to_num(columns[:, 5]).astype(np.int64),
+        )
+
+    def _apply_placements(self, ids, xs, ys, colors, timestamps, user_ids):
+        """
+        applies placements given as columns, oldest first.
+        a user id of 0 marks a clear of the pixel
+        """
+        if len(ids):
+            self.version = max(self.version, int(ids.max()))
+        on_canvas = (xs >= 0) & (xs < CANVAS_WIDTH) & (ys >= 0) & (ys < CANVAS_HEIGHT)
+        if not on_canvas.all():
+            ids, xs, ys, colors, timestamps, user_ids = (
+                column[on_canvas] for column in (ids, xs, ys, colors, timestamps, user_ids)
+            )
+        if len(ids) == 0:
+            return
+
+        # resolve each distinct user to its index once, looking up the names of new users together
+        unique_ids, inverse = np.unique(user_ids, return_inverse=True)
+        new_ids = [user_id for user_id in unique_ids.tolist() if user_id != 0 and user_id not in self.user_indices]
+        if new_ids:
+            names = dict(User.objects.filter(id__in=new_ids).values_list("id", "username"))
+            for user_id in new_ids:
+                self._get_user_index(user_id, names.get(user_id, ""))
+        indices = np.array([self.user_indices.get(user_id, 0) for user_id in unique_ids.tolist()], np.int32)
+        owners = indices[inverse.ravel()]
+
+        # only the newest placement on each pixel is visible
+        flat = ys*CANVAS_WIDTH + xs
+        _, newest = np.unique(flat[::-1], return_index=True)
+        newest = len(flat) - 1 - newest
+        self.pixels.reshape(-1)[flat[newest]] = colors[newest]
+        self.owners.reshape(-1)[flat[newest]] = owners[newest]
+        self.timestamps.reshape(-1)[flat[newest]] = timestamps[newest]
+
+        np.maximum.at(self.tile_versions, (ys // TILE_SIZE, xs // TILE_SIZE), ids)
+
+    def _get_user_index(self, user_id, name):
+        index = self.user_indices.get(user_id)
+        if index is None:
+            index = self.user_indices[user_id] = len(self.users)
+            self.users.append(name)
+        return index
+
+    def _set_pixel(self, user_id, name, x, y, c, timestamp):
+        self.pixels[y, x] = c
+        self.owners[y, x] = self._get_user_index(user_id, name)
+        self.timestamps[y, x] = timestamp
+
+    def _clear_area(self, x1, y1, x2, y2, timestamp):
+        self.pixels[y1:y2+1, x1:x2+1] = 0
+        self.owners[y1:y2+1, x1:x2+1] = 0
+        self.timestamps[y1:y2+1, x1:x2+1] = timestamp
+
+    def _erase_user(self, name, timestamp) -> np.ndarray:
+        """returns the flat indices of the erased pixels"""
+        try:
+            index = self.users.index(name, 1)
+        except ValueError:
+            return np.zeros(0, np.int64)
+        mask = self.owners == index
+        self.pixels[mask] = 0
+        self.owners[mask] = 0
+        self.timestamps[mask] = timestamp
+        return np.flatnonzero(mask)
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from place.timelapse import build_keyframes, first_placement_time, iter_frames
+
+from time import time
+import struct
+import zlib
+
+
+class Command(BaseCommand):
+    help = "Saves canvas keyframes, or exports the canvas over a span of time as a stream of frames"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--keyframes", type=float, metavar="INTERVAL",
+                            help="save a keyframe every INTERVAL seconds of canvas time, carrying on from the last one")
+        parser.add_argument("--export", metavar="FILE",
+                            help="write frames to FILE, each a <dI header of timestamp and length "
+                                 "followed by the zlib compressed colors of every pixel")
+        parser.add_argument("--start", type=float,
+                            help="timestamp of the first exported frame, defaults to the first placement")
+        parser.add_argument("--end", type=float, help="timestamp of the last exported frame, defaults to now")
+        parser.add_argument("--step", type=float, default=60, help="seconds of canvas time between exported frames")
+
+    def handle(self, *args, **options):
+        if options["keyframes"] is None and options["export"] is None:
+            raise CommandError("nothing to do, pass --keyframes and/or --export")
+
+        if options["keyframes"] is not None:
+            if options["keyframes"] <= 0:
+                raise CommandError("keyframe interval has to be positive")
+            made = build_keyframes(options["keyframes"])
+            self.stdout.write(f"Saved {made} keyframes")
+
+        if options["export"] is not None:
+            if options["step"] <= 0:
+                raise CommandError("step has to be positive")
+            end = time() if options["end"] is None else options["end"]
+            start = options["start"]
+            if start is None:
+                start = first_placement_time()
+                if start is None:
+                    raise CommandError("there are no placements to export")
+            if start > end:
+                raise CommandError("start has to be before end")
+            frames = 0
+            with open(options["export"], "wb") as f:
+                for timestamp, pixels in iter_frames(start, end, options["step"]):
+                    frame = zlib.compress(pixels.tobytes())
+                    f.write(struct.pack("<dI", timestamp, len(frame)) + frame)
+                    frames += 1
+            self.stdout.write(f"Exported {frames} frames to {options['export']}")
@@ -0,0 +1,52 @@
+# Generated by Django 4.1.7 on 2026-10-18 14:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("place", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BannedUser",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("timestamp", models.FloatField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="placement",
+            index=models.Index(
+                fields=["x", "y", "-timestamp"], name="placement_pixel_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="placement",
+            index=models.Index(
+                fields=["user", "-timestamp"], name="placement_user_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="banneduser",
+            name="user",
+            field=models.OneToOneField(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="place_ban",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
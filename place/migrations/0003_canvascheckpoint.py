@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("place", "0002_placement_indexes_banneduser"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CanvasCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("placement_id", models.PositiveIntegerField(db_index=True)),
+                ("timestamp", models.FloatField()),
+                ("pixels", models.BinaryField()),
+                ("owners", models.BinaryField()),
+                ("timestamps", models.BinaryField()),
+                ("user_ids", models.BinaryField()),
+            ],
+        ),
+    ]
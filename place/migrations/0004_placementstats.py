@@ -0,0 +1,48 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0009_userchannel_is_enabled_and_more"),
+        ("place", "0003_canvascheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PlacementStats",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="placement_stats",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("placements", models.PositiveIntegerField(default=0)),
+                ("last_placement", models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="placementstats",
+            index=models.Index(
+                fields=["-placements", "user"], name="placementstats_rank_idx"
+            ),
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO place_placementstats (user_id, placements, last_placement)
+            SELECT user_id, COUNT(*), MAX(timestamp) FROM place_placement
+            WHERE user_id IS NOT NULL
+            GROUP BY user_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
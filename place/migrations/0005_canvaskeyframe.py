@@ -0,0 +1,29 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("place", "0004_placementstats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CanvasKeyframe",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("timestamp", models.FloatField(unique=True)),
+                ("pixels", models.BinaryField()),
+            ],
+        ),
+    ]
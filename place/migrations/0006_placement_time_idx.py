@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("place", "0005_canvaskeyframe"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="placement",
+            index=models.Index(fields=["timestamp", "id"], name="placement_time_idx"),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, connection
 from django.contrib.auth import get_user_model
 
 
@@ -11,3 +11,76 @@ class Placement(models.Model):
     x = models.PositiveSmallIntegerField()
     y = models.PositiveSmallIntegerField()
     color = models.PositiveSmallIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["x", "y", "-timestamp"], name="placement_pixel_idx"),
+            models.Index(fields=["user", "-timestamp"], name="placement_user_idx"),
+            # replaying history in time order, see place.timelapse
+            models.Index(fields=["timestamp", "id"], name="placement_time_idx"),
+        ]
+
+
+class BannedUser(models.Model):
+    user = models.OneToOneField(User, models.CASCADE, related_name="place_ban")
+    timestamp = models.FloatField()
+
+
+class CanvasCheckpoint(models.Model):
+    # newest placement the checkpoint includes, later ones are replayed on top of it
+    placement_id = models.PositiveIntegerField(db_index=True)
+    timestamp = models.FloatField()
+    # zlib compressed canvas arrays, and the user id of each owner index
+    pixels = models.BinaryField()
+    owners = models.BinaryField()
+    timestamps = models.BinaryField()
+    user_ids = models.BinaryField()
+
+
+class CanvasKeyframe(models.Model):
+    """Colors of the whole canvas at a point in canvas time, see place.timelapse"""
+
+    timestamp = models.FloatField(unique=True)
+    # zlib compressed, one byte per pixel
+    pixels = models.BinaryField()
+
+
+class PlacementStats(models.Model):
+    """Running totals of each user's placements, kept up to date by whatever writes placements"""
+
+    user = models.OneToOneField(User, models.CASCADE, primary_key=True, related_name="placement_stats")
+    placements = models.PositiveIntegerField(default=0)
+    last_placement = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["-placements", "user"], name="placementstats_rank_idx"),
+        ]
+
+    @staticmethod
+    def record(placements):
+        """adds a batch of placements to the totals, meant to run in the same transaction that writes them"""
+        totals = {}
+        for placement in placements:
+            if placement.user_id is None:
+                continue
+            count, last = totals.get(placement.user_id, (0, 0))
+            totals[placement.user_id] = (count + 1, max(last, placement.timestamp))
+        if not totals:
+            return
+        # one statement for the whole batch, with a column array each
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO place_placementstats (user_id, placements, last_placement)
+                SELECT * FROM unnest(%s::bigint[], %s::integer[], %s::double precision[])
+                ON CONFLICT (user_id) DO UPDATE SET
+                    placements = place_placementstats.placements + EXCLUDED.placements,
+                    last_placement = GREATEST(place_placementstats.last_placement, EXCLUDED.last_placement)
+                """,
+                [
+                    list(totals),
+                    [count for count, _ in totals.values()],
+                    [last for _, last in totals.values()],
+                ]
+            )
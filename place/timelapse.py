@@ -0,0 +1,133 @@
+from django.db import connection
+
+from .canvas import CANVAS_WIDTH, CANVAS_HEIGHT, LOAD_CHUNK_SIZE
+from .models import CanvasKeyframe
+
+from time import time
+import zlib
+
+import numpy as np
+
+
+__all__ = (
+    "KEYFRAME_DELAY",
+    "build_keyframes",
+    "canvas_at",
+    "first_placement_time",
+    "iter_frames",
+)
+
+
+# keyframes are only made for canvas time at least this far in the past,
+# so placements still waiting to be written can't end up missing from them
+KEYFRAME_DELAY = 60
+
+
+def _iter_placements(after, until):
+    """
+    streams (timestamp, x, y, color) columns of the placements in (after, until], oldest first.
+    clears are placements of color 0
+    """
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT timestamp, x, y, color FROM place_placement
+            WHERE timestamp > %s AND timestamp <= %s
+            ORDER BY timestamp, id
+            """,
+            [after, until]
+        )
+        while rows := cursor.fetchmany(LOAD_CHUNK_SIZE):
+            columns = np.array(rows, np.float64)
+            yield columns[:, 0], columns[:, 1].astype(np.int64), columns[:, 2].astype(np.int64), \
+                columns[:, 3].astype(np.uint8)
+
+
+def _apply_colors(pixels, xs, ys, colors):
+    """applies placements given as columns, oldest first, to a [y, x] array of colors"""
+    on_canvas = (xs >= 0) & (xs < CANVAS_WIDTH) & (ys >= 0) & (ys < CANVAS_HEIGHT)
+    flat = (ys*CANVAS_WIDTH + xs)[on_canvas]
+    colors = colors[on_canvas]
+    # only the newest placement on each pixel is visible
+    _, newest = np.unique(flat[::-1], return_index=True)
+    newest = len(flat) - 1 - newest
+    pixels.reshape(-1)[flat[newest]] = colors[newest]
+
+
+def _start_from(timestamp) -> tuple[float, np.ndarray]:
+    """the newest keyframe at or before timestamp, or a blank canvas from the beginning"""
+    keyframe = CanvasKeyframe.objects.filter(timestamp__lte=timestamp).order_by("-timestamp").first()
+    if keyframe is None:
+        return float("-inf"), np.zeros((CANVAS_HEIGHT, CANVAS_WIDTH), np.uint8)
+    pixels = np.frombuffer(zlib.decompress(keyframe.pixels), np.uint8).reshape((CANVAS_HEIGHT, CANVAS_WIDTH))
+    return keyframe.timestamp, pixels.copy()
+
+
+def iter_frames(start, end, step):
+    """
+    yields (timestamp, colors) of the canvas every step seconds from start to end,
+    replaying the history once from the keyframe before start
+    """
+    timestamp, pixels = _start_from(start)
+    frame_time = start
+    for times, xs, ys, colors in _iter_placements(timestamp, end):
+        # split the chunk where it crosses frame times
+        i = 0
+        while i < len(times):
+            j = int(np.searchsorted(times, frame_time, "right"))
+            if j >= len(times):
+                _apply_colors(pixels, xs[i:], ys[i:], colors[i:])
+                break
+            _apply_colors(pixels, xs[i:j], ys[i:j], colors[i:j])
+            i = j
+            yield frame_time, pixels
+            frame_time += step
+            if frame_time > end:
+                return
+    while frame_time <= end:
+        yield frame_time, pixels
+        frame_time += step
+
+
+def canvas_at(timestamp) -> np.ndarray:
+    """colors of the canvas as it was at timestamp, replayed from the keyframe before it"""
+    for _, pixels in iter_frames(timestamp, timestamp, 1):
+        return pixels
+
+
+def first_placement_time() -> float | None:
+    """timestamp of the oldest placement, or None if there are none"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(timestamp) FROM place_placement")
+        return cursor.fetchone()[0]
+
+
+def build_keyframes(interval) -> int:
+    """
+    saves a keyframe every interval seconds of canvas time, carrying on from the newest one.
+    intervals in which nothing changed are skipped, the keyframe before them still applies.
+    returns how many were made
+    """
+    newest = CanvasKeyframe.objects.order_by("-timestamp").first()
+    if newest is None:
+        first = first_placement_time()
+        if first is None:
+            return 0
+        # the first keyframe is at or before the first placement, so there's one for any point in history
+        start = first - first % interval
+        previous = None
+    else:
+        start = newest.timestamp + interval
+        previous = np.frombuffer(zlib.decompress(newest.pixels), np.uint8).reshape((CANVAS_HEIGHT, CANVAS_WIDTH))
+
+    made = 0
+    end = time() - KEYFRAME_DELAY
+    if start > end:
+        return made
+    for timestamp, pixels in iter_frames(start, end, interval):
+        if previous is not None and np.array_equal(pixels, previous):
+            continue
+        CanvasKeyframe.objects.create(timestamp=timestamp, pixels=zlib.compress(pixels.tobytes()))
+        previous = pixels.copy()
+        made += 1
+    return made
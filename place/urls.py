@@ -4,5 +4,7 @@ from . import views
 
 urlpatterns = [
     path("", views.canvas, name="canvas"),
+    path("tiles/<int:x>/<int:y>/", views.canvas_tile, name="canvas_tile"),
+    path("history/<int:timestamp>/", views.canvas_history, name="canvas_history"),
     path("leaderboard/", views.leaderboard, name="canvas_leaderboard")
 ]
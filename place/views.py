@@ -1,23 +1,122 @@
 from django.contrib.auth import get_user_model
+from django.db.models import Max
+from django.http import HttpResponse, Http404
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
 
 from common.views import render
+from .canvas import CanvasState, TILE_COLUMNS, TILE_ROWS
+from .timelapse import KEYFRAME_DELAY, canvas_at
+from .models import Placement, PlacementStats, CanvasKeyframe
+
+from time import time
+import threading
+import zlib
 
 User = get_user_model()
 
+# how often the tile canvas picks up new placements from the database
+CANVAS_SYNC_INTERVAL = 1
+
+canvas_state = None
+canvas_state_lock = threading.Lock()
+
+LEADERBOARD_PAGE_SIZE = 50
+# a cached page is reused until there's a newer placement, and for at least this many seconds regardless
+LEADERBOARD_MIN_AGE = 10
+
+# page: (newest placement id, time computed, rows)
+leaderboard_cache = {}
+
+
+def get_canvas_state():
+    global canvas_state
+    if canvas_state is None:
+        # only the first of concurrent first requests loads it
+        with canvas_state_lock:
+            if canvas_state is None:
+                state = CanvasState()
+                state.load()
+                canvas_state = state
+                return canvas_state
+    canvas_state.sync(CANVAS_SYNC_INTERVAL)
+    return canvas_state
+
 
 def canvas(req):
     return render(req, "place/index.html")
 
 
-def leaderboard(req):
-    users = list(
-        sorted(
-            filter(
-                lambda u: u.blocks_placed > 0,
-                User.objects.all()
-            ),
-            key=lambda u: u.blocks_placed,
-            reverse=True
-        )
+def canvas_tile(req, x, y):
+    if not 0 <= x < TILE_COLUMNS or not 0 <= y < TILE_ROWS:
+        raise Http404()
+
+    state = get_canvas_state()
+    # read before the tile, which is then complete up to at least this placement even if a sync happens in between.
+    # the websocket server replays what comes after it
+    placement_id = state.version
+    version, tile = state.get_tile(x, y)
+    etag = quote_etag(str(version))
+
+    resp = get_conditional_response(req, etag=etag)
+    if resp is None:
+        resp = HttpResponse(tile, content_type="application/octet-stream")
+    resp["ETag"] = etag
+    resp["X-Placement-Version"] = str(placement_id)
+    # cacheable anywhere, but always revalidated against the tile version
+    patch_cache_control(resp, public=True, no_cache=True)
+    return resp
+
+
+def canvas_history(req, timestamp):
+    """the whole canvas as it was at timestamp, zlib compressed with one byte per pixel"""
+    # keyframes are made by the websocket server (or manage.py timelapse --keyframes),
+    # and replaying from the very beginning without one is too slow to do for a request
+    if not CanvasKeyframe.objects.filter(timestamp__lte=timestamp).exists():
+        raise Http404()
+    pixels = canvas_at(timestamp)
+    resp = HttpResponse(zlib.compress(pixels.tobytes()), content_type="application/octet-stream")
+    if timestamp < time() - KEYFRAME_DELAY:
+        # the past doesn't change anymore
+        patch_cache_control(resp, public=True, max_age=86400, immutable=True)
+    else:
+        patch_cache_control(resp, no_cache=True)
+    return resp
+
+
+def get_leaderboard_page(page) -> list[dict]:
+    """returns up to one more row than fits on the page, to tell whether there's a next one"""
+    cached = leaderboard_cache.get(page)
+    if cached is not None and time() - cached[1] < LEADERBOARD_MIN_AGE:
+        return cached[2]
+    placement_id = Placement.objects.aggregate(Max("id"))["id__max"]
+    if cached is not None and cached[0] == placement_id:
+        return cached[2]
+
+    # read in order off the rank index of the running totals
+    start = page*LEADERBOARD_PAGE_SIZE
+    rows = list(
+        PlacementStats.objects.filter(placements__gt=0)
+        .order_by("-placements", "user_id")
+        .values("user__username", "placements")[start:start+LEADERBOARD_PAGE_SIZE+1]
     )
-    return render(req, "place/leaderboard.html", context={"users": users})
+    # pages past the last one aren't kept, so the cache is bounded by the number of users
+    if rows or page == 0:
+        leaderboard_cache[page] = (placement_id, time(), rows)
+    return rows
+
+
+def leaderboard(req):
+    try:
+        page = max(int(req.GET.get("page", 1)), 1) - 1
+    except ValueError:
+        raise Http404()
+
+    rows = get_leaderboard_page(page)
+    if not rows and page > 0:
+        raise Http404()
+    return render(req, "place/leaderboard.html", context={
+        "users": rows[:LEADERBOARD_PAGE_SIZE],
+        "rank_offset": page*LEADERBOARD_PAGE_SIZE,
+        "previous_page": page if page > 0 else None,
+        "next_page": page + 2 if len(rows) > LEADERBOARD_PAGE_SIZE else None,
+    })
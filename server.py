@@ -2,22 +2,36 @@ import asyncio
 import django
 import websockets
 import os
-from time import time
+import struct
+import pickle
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+from time import time, perf_counter, monotonic
 import threading
+import signal
+from collections import deque
+from itertools import islice, takewhile
 from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 from dotenv import load_dotenv
-from functools import partial
 import logging
 
 load_dotenv()
 os.environ["DJANGO_SETTINGS_MODULE"] = "offlinechatbot.settings"
 django.setup()
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import connection
+from django.db import connection, transaction, close_old_connections
 from sesame.utils import get_user as _get_user
 
+from main.models import UserPermissions
+from place.canvas import CANVAS_WIDTH, CANVAS_HEIGHT, CanvasState, save_checkpoint
+from place.models import Placement, BannedUser, PlacementStats
+from place.timelapse import build_keyframes
+
 
 # TODO: eventually would be good to rewrite this file
 
@@ -31,8 +45,77 @@ formatter = logging.Formatter("%(asctime)s [%(levelname)s]: %(message)s")
 ch.setFormatter(formatter)
 _log.addHandler(ch)
 
-CANVAS_WIDTH = 750
-CANVAS_HEIGHT = 750
+# binary frames start with one of these opcodes
+CANVAS_FRAME = 0
+OWNERS_FRAME = 1
+EVENTS_FRAME = 2
+
+# canvas events packed into an EVENTS_FRAME, after the seq of the first one
+PLACE_EVENT = 0
+CLEAR_EVENT = 1
+ERASE_EVENT = 2
+
+# binary frames sent by clients start with one of these opcodes
+PLACE_COMMAND = 0
+
+# number of recent canvas events kept for clients catching up after a reconnect
+HISTORY_SIZE = 10000
+
+# placements are written to the database every FLUSH_INTERVAL seconds, or sooner once FLUSH_SIZE are waiting
+FLUSH_INTERVAL = 0.5
+FLUSH_SIZE = 1000
+
+# seconds between checkpoints of the canvas, which keep startup from replaying the whole placement history
+CHECKPOINT_INTERVAL = 600
+# seconds of canvas time between timelapse keyframes, which are brought up to date along with each checkpoint
+KEYFRAME_INTERVAL = 3600
+
+# canvas events are batched into one message per client over this many seconds
+BROADCAST_INTERVAL = 0.025
+# clients with more messages than this waiting to be sent get disconnected
+OUTBOUND_QUEUE_SIZE = 256
+
+# commands allowed per second, and in a burst, for each connection and for each user across their connections
+CONNECTION_COMMAND_RATE = 10
+CONNECTION_COMMAND_BURST = 20
+USER_COMMAND_RATE = 20
+USER_COMMAND_BURST = 40
+
+# verified tokens are remembered briefly, enough for connections racing with the same token to share a lookup.
+# it's counted from verification rather than from when the token was made, so it has to stay well under
+# SESAME_MAX_AGE to not keep tokens working past their expiry. the cache is pruned past TOKEN_CACHE_SIZE
+TOKEN_CACHE_TTL = min(1, settings.SESAME_MAX_AGE)
+TOKEN_CACHE_SIZE = 10000
+
+# threads for blocking database work in response to clients, which should fit in the postgres connection budget,
+# and how many more calls may wait for one before clients are told BUSY
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS") or 8)
+DB_EXECUTOR_QUEUE = int(os.getenv("DB_EXECUTOR_QUEUE") or 64)
+# seconds between logging how long database calls waited and ran
+DB_STATS_INTERVAL = 60
+
+
+class RateLimiter:
+    """Token bucket, refilled at rate tokens per second up to burst"""
+
+    __slots__ = ("rate", "burst", "tokens", "last_update")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_update = monotonic()
+
+    def take(self) -> bool:
+        """event loop safe"""
+        # monotonic, so the clock being set back can't drain the bucket
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
 
 
 class User:
@@ -42,27 +125,27 @@ class User:
     can_mod: bool
     banned: bool
 
-    __slots__ = ("id", "name", "last_placement", "is_mod", "is_admin", "can_mod", "banned")
+    __slots__ = ("id", "name", "last_placement", "is_mod", "is_admin", "can_mod", "banned", "rate_limiter")
 
     def __init__(self, user: UserModel):
+        """not event loop safe"""
         self.id = user.id
-        self.name = user.twitch_name
-        self.last_placement = user.last_placement
+        self.name = user.username
+        self.last_placement = PlacementStats.objects.filter(user_id=user.id).values_list(
+            "last_placement", flat=True
+        ).first() or 0
+        self.banned = BannedUser.objects.filter(user_id=user.id).exists()
+        # shared by all of the user's connections, since they share this object
+        self.rate_limiter = RateLimiter(USER_COMMAND_RATE, USER_COMMAND_BURST)
         self.update(user)
 
     def update(self, user):
-        self.is_mod = user.is_mod
+        self.is_mod = user.permissions is not None and UserPermissions.MODERATOR in user.permissions
         self.is_admin = user.is_admin
-        self.can_mod = user.can_mod
-        self.banned = user.banned
+        self.can_mod = self.is_mod or self.is_admin
 
     def on_place(self):
         self.last_placement = time()
-        user = self.get_object()
-        user.blocks_placed += 1
-        user.last_placement = self.last_placement
-        self.update(user)
-        user.save()
 
     def can_place(self, cooldown):
         return not (self.banned or time() - self.last_placement < cooldown)
@@ -83,9 +166,6 @@ class User:
     def can_clear_user(self):
         return self.can_mod
 
-    def get_object(self):
-        return UserModel.objects.get(id=self.id)
-
 
 class AnonymousUser:
     is_authenticated = False
@@ -96,16 +176,40 @@ class WebsocketWrapper:
         self.ws = ws
         self.user: USER_TYPE = user
         self.last_message = ""
+        # messages are sent by write_messages so a slow client never holds up the sender
+        self.outbound: asyncio.Queue = asyncio.Queue(OUTBOUND_QUEUE_SIZE)
+        self.is_overflowed = False
+        # whether canvas events are sent as EVENTS_FRAMEs instead of text
+        self.is_binary = False
+        self.rate_limiter = RateLimiter(CONNECTION_COMMAND_RATE, CONNECTION_COMMAND_BURST)
 
     def __getattr__(self, item):
         return getattr(self.ws, item)
 
     async def send(self, msg, log=True):
+        """never waits on the client"""
         if log and type(msg) == str and msg != "PONG" and len(msg) < 1000:
             _log.info(f"Sending to {self.ws.id}: {msg}")
 
-        await self.ws.send(msg)
-        
+        self.enqueue(msg)
+
+    def enqueue(self, msg):
+        if self.is_overflowed:
+            return
+        try:
+            self.outbound.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.is_overflowed = True
+            _log.warning(f"Disconnecting {self.ws.id} for falling too far behind")
+            asyncio.get_running_loop().create_task(self.ws.close(1013, "Too far behind"))
+
+    async def write_messages(self):
+        try:
+            while True:
+                await self.ws.send(await self.outbound.get())
+        except websockets.ConnectionClosed:
+            pass
+
     async def recv(self, do_check=False):
         msg = await self.ws.recv()
         if do_check and self.last_message.lower() == msg.lower():
@@ -117,142 +221,761 @@ class WebsocketWrapper:
 USER_TYPE = Union[User, AnonymousUser]
 
 
-class Canvas:
-    def __init__(self):
-        self.lock: threading.Lock = threading.Lock()
+def run_with_connection(func, *args):
+    """
+    not event loop safe
+    does what django does around each request, so the thread's connection is replaced
+    once it's broken or older than CONN_MAX_AGE instead of failing the next query
+    """
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+class DatabaseExecutor:
+    """
+    Thread pool for blocking database work. Calls beyond what it can queue are refused instead of
+    piling up, and how long each kind of call waited for a thread and ran for is recorded
+    """
+
+    # upper bounds of the timing histogram buckets, in milliseconds
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
+    def __init__(self, loop, workers, max_queued):
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="db")
+        self.limit = workers + max_queued
+        self.pending = 0
+        # name of the call: (wait histogram, run histogram)
+        self.timings: dict[str, tuple[list[int], list[int]]] = {}
+        self.timings_lock: threading.Lock = threading.Lock()
+
+    def submit(self, func, *args) -> asyncio.Future:
+        """event loop safe, raises ExecutorBusy if too many calls are waiting already"""
+        if self.pending >= self.limit:
+            raise ExecutorBusy()
+        self.pending += 1
+        future = self.loop.run_in_executor(self.executor, self._run, func, perf_counter(), *args)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        self.pending -= 1
+
+    def _run(self, func, submitted, *args):
+        started = perf_counter()
+        try:
+            return run_with_connection(func, *args)
+        finally:
+            self._record(func, started - submitted, perf_counter() - started)
+
+    def _record(self, func, wait, run):
+        name = func.__qualname__
+        self.timings_lock.acquire()
+        timings = self.timings.get(name)
+        if timings is None:
+            timings = self.timings[name] = ([0] * len(self.BUCKETS), [0] * len(self.BUCKETS))
+        for histogram, seconds in zip(timings, (wait, run)):
+            histogram[next(i for i, bound in enumerate(self.BUCKETS) if seconds * 1000 <= bound)] += 1
+        self.timings_lock.release()
+
+    def _percentile(self, histogram, fraction):
+        target = fraction * sum(histogram)
+        count = 0
+        for bound, bucket in zip(self.BUCKETS, histogram):
+            count += bucket
+            if count >= target:
+                return bound
+
+    def log_stats(self):
+        """event loop safe"""
+        self.timings_lock.acquire()
+        timings, self.timings = self.timings, {}
+        self.timings_lock.release()
+        _log.info(f"Database executor: {self.pending} calls pending")
+        for name, (wait, run) in timings.items():
+            _log.info(
+                f"{name}: {sum(run)} calls, "
+                f"waited p50 <= {self._percentile(wait, 0.5)}ms p99 <= {self._percentile(wait, 0.99)}ms, "
+                f"ran p50 <= {self._percentile(run, 0.5)}ms p99 <= {self._percentile(run, 0.99)}ms"
+            )
 
-        self.canvas_cache = None
-        self.user_cache = None
+    async def run_stats_logger(self):
+        while True:
+            await asyncio.sleep(DB_STATS_INTERVAL)
+            self.log_stats()
 
-    @staticmethod
-    def create_placement(user, x, y, c, timestamp=None):
-        return {
-            "timestamp": timestamp or time(),
-            "user": user,
-            "coordinate": [x, y],
-            "color": c,
-        }
 
-    def _update_cache(self):
+class ClearRegion:
+    """Clears every pixel in a rectangle with a single insert, without creating a Placement for each"""
+
+    __slots__ = ("timestamp", "x1", "y1", "x2", "y2")
+
+    def __init__(self, timestamp, x1, y1, x2, y2):
+        self.timestamp = timestamp
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+
+    def write(self):
         with connection.cursor() as cursor:
             cursor.execute(
                 """
-                SELECT DISTINCT ON (x, y) (
-                    x,
-                    y,
-                    color,
-                    main_user.username
-                ) FROM place_placement
-                INNER JOIN main_user ON (main_user.id = place_placement.user_id)
-                ORDER BY x, y, timestamp DESC
-                """
+                INSERT INTO place_placement (timestamp, user_id, x, y, color)
+                SELECT %s, NULL, x, y, 0
+                FROM generate_series(%s, %s) AS x, generate_series(%s, %s) AS y
+                """,
+                [self.timestamp, self.x1, self.x2, self.y1, self.y2]
             )
-            placements = cursor.fetchall()
-        self.canvas_cache = bytearray(CANVAS_WIDTH*CANVAS_HEIGHT)
-        users = ["" for _ in range(CANVAS_WIDTH*CANVAS_HEIGHT)]
-        for placement in placements:
-            placement = placement[0][1:-1].split(",")
-            i = int(placement[0]) + int(placement[1]) * 750
-            try:
-                users[i] = placement[3]
-                self.canvas_cache[i] = int(placement[2])
-            except IndexError:
-                continue
-        self.user_cache = " ".join(users)
 
-    def reset_cache(self):
-        self.canvas_cache = None
-        self.user_cache = None
 
-    def get_canvas_info(self):
+class PlacementWriter:
+    """Holds placements in memory and writes them to the database in batches"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lock: threading.Lock = threading.Lock()
+        self.flush_lock: threading.Lock = threading.Lock()
+        self.pending: list[Placement | ClearRegion] = []
+        self.pending_seq = 0
+        # (placement id, seq) after each flush: every placement up to the id came from canvas events up to the seq
+        self.durable_marks: deque[tuple[int, int]] = deque(maxlen=HISTORY_SIZE)
+        self.is_full = asyncio.Event()
+
+    def add(self, placements: list[Placement | ClearRegion], seq: int):
+        """
+        thread safe
+        expects to be called in the same order the events were recorded
+        """
         self.lock.acquire()
-        if self.canvas_cache is None or self.user_cache is None:
-            self._update_cache()
+        self.pending.extend(placements)
+        self.pending_seq = seq
+        is_full = len(self.pending) >= FLUSH_SIZE
         self.lock.release()
-        return self.canvas_cache, self.user_cache
+        if is_full:
+            self.loop.call_soon_threadsafe(self.is_full.set)
 
-    # TODO: fix later (cuz no longer using mongodb)
-
-    def get_last_pixel(self, x, y):
+    def get_durable_marks(self, after_seq=-1) -> list[tuple[int, int]]:
+        """thread safe, returns the durable marks with a seq after after_seq, oldest first"""
         self.lock.acquire()
-        placement = self.db.placements.find_one({"coordinate": [x, y]}, sort=[('timestamp', -1)])
+        marks = list(takewhile(lambda mark: mark[1] > after_seq, reversed(self.durable_marks)))
         self.lock.release()
-        return placement
+        return marks[::-1]
 
-    def place_pixel(self, user: User, x: int, y: int, c: int):
+    def flush(self):
+        """not event loop safe"""
+        self.flush_lock.acquire()
         self.lock.acquire()
-        self.db.placements.insert_one(self.create_placement(user.name, x, y, c))
-        self.reset_cache()
+        placements, self.pending = self.pending, []
+        seq = self.pending_seq
         self.lock.release()
+        if not placements:
+            self.flush_lock.release()
+            return
+        try:
+            with transaction.atomic():
+                self._write(placements)
+                PlacementStats.record(placement for placement in placements if isinstance(placement, Placement))
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT MAX(id) FROM place_placement")
+                    placement_id = cursor.fetchone()[0]
+            self.lock.acquire()
+            self.durable_marks.append((placement_id, seq))
+            self.lock.release()
+        except Exception:
+            # put them back to be retried by the next flush
+            self.lock.acquire()
+            self.pending[:0] = placements
+            self.lock.release()
+            raise
+        finally:
+            self.flush_lock.release()
+
+    @staticmethod
+    def _write(placements):
+        # keeps the order of placements and clears, grouping placements in between clears
+        batch = []
+        for placement in placements:
+            if isinstance(placement, Placement):
+                batch.append(placement)
+                continue
+            if batch:
+                Placement.objects.bulk_create(batch, batch_size=FLUSH_SIZE)
+                batch = []
+            placement.write()
+        if batch:
+            Placement.objects.bulk_create(batch, batch_size=FLUSH_SIZE)
+
+    async def run(self, executor):
+        while True:
+            try:
+                await asyncio.wait_for(self.is_full.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.is_full.clear()
+            try:
+                await self.loop.run_in_executor(executor, run_with_connection, self.flush)
+            except Exception as exc:
+                _log.exception("Failed to write placements", exc_info=exc)
+
+
+class CanvasView(CanvasState):
+    """What the websocket server reads from the canvas: snapshots, owners and the history of canvas events"""
+
+    def __init__(self, shared_path=None, writable=True):
+        super().__init__(shared_path, writable)
+
+        self.user_table_cache = None
+        self.owners_cache = None
+
+        # every canvas event gets the next seq, epoch tells apart seqs from different server runs
+        self.epoch = int(time())
+        self.seq = 0
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.history_lock: threading.Lock = threading.Lock()
+
+    def get_canvas_info(self):
+        with self.lock:
+            info = bytes((CANVAS_FRAME,)) + self.pixels.tobytes()
+        return info
+
+    def get_owner_info(self):
+        """returns the user table message and owners frame"""
+        with self.lock:
+            if self.owners_cache is None:
+                owners = self.owners.astype("<u2" if len(self.users) <= 0x10000 else "<u4")
+                self.owners_cache = struct.pack("<BBxx", OWNERS_FRAME, owners.itemsize) + owners.tobytes()
+            info = self.get_user_table(), self.owners_cache
+        return info
+
+    def get_user_table(self):
+        """event loop safe"""
+        users = self.users[1:]
+        if self.user_table_cache is None or self.user_table_cache[0] != len(users):
+            self.user_table_cache = (len(users), "USERTABLE " + " ".join(users))
+        return self.user_table_cache[1]
+
+    def get_name(self, index) -> str:
+        """event loop safe"""
+        # a shared canvas can be ahead of the events that tell about new users
+        return self.users[index] if index < len(self.users) else ""
+
+    def get_owner(self, x, y) -> str:
+        """event loop safe"""
+        return self.get_name(self.owners[y, x])
+
+    def get_events_since(self, seq, until=None) -> list[tuple[int, str, bytes]] | None:
+        """
+        event loop safe
+        returns the events after seq up to and including until,
+        or None if they are no longer all in the history
+        """
+        self.history_lock.acquire()
+        if until is None:
+            until = self.seq
+        if seq >= until:
+            events = [] if seq <= self.seq else None
+        elif not self.history or self.history[0][0] > seq + 1:
+            events = None
+        else:
+            first = self.history[0][0]
+            events = list(islice(self.history, seq + 1 - first, until + 1 - first))
+        self.history_lock.release()
+        return events
+
+    def get_events_since_placement(
+        self, placement_id, durable_marks, until=None
+    ) -> list[tuple[int, str, bytes]] | None:
+        """
+        event loop safe
+        returns events that cover every placement after placement_id, up to and including until,
+        or None if they are no longer all in the history. durable_marks are as in PlacementWriter.durable_marks.
+        some of them may be from before placement_id, which is harmless as long as they're applied in order
+        """
+        for mark_id, seq in reversed(durable_marks):
+            if mark_id <= placement_id:
+                return self.get_events_since(seq, until)
+        return None
+
+    def get_last_pixel(self, x, y) -> tuple[str, int]:
+        """
+        event loop safe
+        returns the owner and color of a pixel
+        """
+        return self.get_name(self.owners[y, x]), int(self.pixels[y, x])
+
+
+class Canvas(CanvasView):
+    """The canvas in the process that applies every change to it and writes them to the database"""
+
+    def __init__(self, writer: PlacementWriter, shared_path=None):
+        super().__init__(shared_path)
+
+        self.writer = writer
+
+        # authoritative from here on, only rebuilt from the database on startup
+        self.load()
+        self.writer.durable_marks.append((self.version, self.seq))
+
+    def get_durable_marks(self) -> list[tuple[int, int]]:
+        """event loop safe"""
+        return self.writer.get_durable_marks()
+
+    def checkpoint(self):
+        """
+        not event loop safe
+        the snapshot is saved once everything in it is written, at the placement id of a flush from before it.
+        whatever it has from after that id gets replayed over it on load anyway
+        """
+        with self.lock:
+            snapshot = self._snapshot()
+            seq = self.seq
+        self.writer.flush()
+        for placement_id, mark_seq in reversed(self.writer.get_durable_marks()):
+            if mark_seq <= seq:
+                break
+        else:
+            raise RuntimeError("no durable mark from before the canvas snapshot is left")
+        save_checkpoint(placement_id, *snapshot)
+        _log.info(f"Saved canvas checkpoint at placement {placement_id}")
+
+    async def run_checkpointer(self, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            try:
+                await loop.run_in_executor(executor, run_with_connection, self.checkpoint)
+            except Exception as exc:
+                _log.exception("Failed to save canvas checkpoint", exc_info=exc)
+            try:
+                made = await loop.run_in_executor(executor, run_with_connection, build_keyframes, KEYFRAME_INTERVAL)
+                if made:
+                    _log.info(f"Saved {made} canvas keyframes")
+            except Exception as exc:
+                _log.exception("Failed to save canvas keyframes", exc_info=exc)
+
+    def _record_event(self, data: bytes, *event):
+        """
+        expects the canvas lock to be held, so events are numbered in the order they're applied.
+        the event is kept both as text and as its packed binary record
+        """
+        self.history_lock.acquire()
+        self.seq += 1
+        self.history.append((self.seq, " ".join(map(str, (event[0], self.seq) + event[1:])), data))
+        self.history_lock.release()
+
+    def place_pixel(self, user_id: int, name: str, x: int, y: int, c: int):
+        """event loop safe, the placement is written to the database later"""
+        with self.lock:
+            # timestamped under the lock, so timestamps are in the same order as seqs and placement ids
+            placement = Placement(timestamp=time(), user_id=user_id, x=x, y=y, color=c)
+            self._set_pixel(user_id, name, x, y, c, placement.timestamp)
+            self.owners_cache = None
+            self._record_event(
+                struct.pack("<BBHHI", PLACE_EVENT, c, x, y, self.owners[y, x]),
+                "PLACE", name, x, y, c
+            )
+            self.writer.add([placement], self.seq)
 
     def clear_canvas(self, x1: int, y1: int, x2: int, y2: int):
-        self.lock.acquire()
-        timestamp = time()
-        self.db.placements.insert_many(sum([
-            [self.create_placement("", x, y, 0, timestamp)
-             for y in range(y1, y2+1)]
-            for x in range(x1, x2+1)], []))
-        self.reset_cache()
-        self.lock.release()
+        """event loop safe, the clear is written to the database later"""
+        with self.lock:
+            timestamp = time()
+            self._clear_area(x1, y1, x2, y2, timestamp)
+            self.owners_cache = None
+            self._record_event(struct.pack("<BHHHH", CLEAR_EVENT, x1, y1, x2, y2), "CLEAR", x1, y1, x2, y2)
+            self.writer.add([ClearRegion(timestamp, x1, y1, x2, y2)], self.seq)
 
     def clear_user(self, user):
-        self.lock.acquire()
-        self.db.placements.delete_many({"user": user})
-        self.reset_cache()
-        self.lock.release()
+        with self.lock:
+            timestamp = time()
+            erased = self._erase_user(user, timestamp)
+            if len(erased):
+                self.owners_cache = None
+                self._record_event(
+                    struct.pack("<BI", ERASE_EVENT, len(erased)) + erased.astype("<u4").tobytes(),
+                    "ERASE", *erased.tolist()
+                )
+                # recorded as clears of each pixel, so the history of placements stays append-only
+                self.writer.add([
+                    Placement(timestamp=timestamp, user_id=None, x=i % CANVAS_WIDTH, y=i // CANVAS_WIDTH, color=0)
+                    for i in erased.tolist()
+                ], self.seq)
+
+
+class CanvasReplica(CanvasView):
+    """Read only view of a shared canvas in a worker process, kept up to date by events from the primary"""
+
+    def __init__(self, shared_path):
+        super().__init__(shared_path, writable=False)
+        self.durable_marks = deque(maxlen=HISTORY_SIZE)
+
+    def start(self, epoch, seq, users, durable_marks):
+        """event loop safe"""
+        self.epoch = epoch
+        self.seq = seq
+        self.users = users
+        self.add_durable_marks(durable_marks)
+
+    def get_durable_marks(self) -> list[tuple[int, int]]:
+        """event loop safe"""
+        return list(self.durable_marks)
+
+    def add_durable_marks(self, marks):
+        """event loop safe"""
+        # the first ones can repeat what the hello message already had
+        last_seq = self.durable_marks[-1][1] if self.durable_marks else -1
+        self.durable_marks.extend(mark for mark in marks if mark[1] > last_seq)
+
+    def add_events(self, events, users_start, new_users, durable_marks):
+        """event loop safe"""
+        with self.lock:
+            self.users[users_start:] = new_users
+            self.owners_cache = None
+
+        self.history_lock.acquire()
+        if events[0][0] != self.seq + 1:
+            # the primary dropped some, so what's left can't be replayed from any earlier seq
+            self.history.clear()
+        self.history.extend(events)
+        self.seq = events[-1][0]
+        self.history_lock.release()
+        self.add_durable_marks(durable_marks)
+
+
+def write_message(writer: asyncio.StreamWriter, message):
+    data = pickle.dumps(message)
+    writer.write(struct.pack("<I", len(data)) + data)
+
+
+async def read_message(reader: asyncio.StreamReader):
+    size, = struct.unpack("<I", await reader.readexactly(4))
+    return pickle.loads(await reader.readexactly(size))
+
+
+class LocalPubSub:
+    """Applies canvas changes right away, when the server runs as a single process"""
+
+    def __init__(self, server: "Server", canvas: Canvas):
+        self.server = server
+        self.canvas = canvas
+
+    async def connect(self):
+        pass
+
+    async def place_pixel(self, user_id, name, x, y, c):
+        self.canvas.place_pixel(user_id, name, x, y, c)
+        self.server.schedule_broadcast()
+
+    async def clear_canvas(self, x1, y1, x2, y2):
+        self.canvas.clear_canvas(x1, y1, x2, y2)
+        self.server.schedule_broadcast()
+
+    async def clear_user(self, name):
+        await self.server.loop.run_in_executor(self.server.executor, self.canvas.clear_user, name)
+        self.server.schedule_broadcast()
+
+    async def ban(self, user_id):
+        await self.server.on_banned(user_id)
+
+
+class UnixPubSub:
+    """Sends canvas changes to the primary process over a unix socket, and receives everyone's events back"""
+
+    def __init__(self, server: "Server", canvas: CanvasReplica, path):
+        self.server = server
+        self.canvas = canvas
+        self.path = path
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        _, epoch, seq, users, durable_marks = await read_message(self.reader)
+        self.canvas.start(epoch, seq, users, durable_marks)
+
+    async def run(self):
+        try:
+            while True:
+                message = await read_message(self.reader)
+                if message[0] == "events":
+                    self.canvas.add_events(*message[1:])
+                    # already batched by the primary
+                    self.server.broadcast_events()
+                elif message[0] == "banned":
+                    await self.server.on_banned(message[1])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            _log.error("Lost connection to the primary process")
+            self.server.stop()
+
+    async def place_pixel(self, user_id, name, x, y, c):
+        write_message(self.writer, ("place", user_id, name, x, y, c))
+
+    async def clear_canvas(self, x1, y1, x2, y2):
+        write_message(self.writer, ("clear", x1, y1, x2, y2))
+
+    async def clear_user(self, name):
+        write_message(self.writer, ("clear_user", name))
+
+    async def ban(self, user_id):
+        write_message(self.writer, ("ban", user_id))
+
+
+class Primary:
+    """
+    Owns the canvas when the server runs as several worker processes. Workers send it their
+    canvas changes over a unix socket, and it publishes the resulting events back to all of them
+    """
+
+    def __init__(self, worker_count, path, shared_path):
+        self.worker_count = worker_count
+        self.path = path
+        self.shared_path = shared_path
+        self.executor = ThreadPoolExecutor()
+        self.loop = asyncio.get_event_loop()
+        self.writer = PlacementWriter(self.loop)
+        self.canvas = Canvas(self.writer, shared_path)
+        self.workers = set()
+        self.processes = []
+        # seq of the last canvas event published to the workers, and size of the user table at that point
+        self.published_seq = 0
+        self.published_users = len(self.canvas.users)
+        self.published_mark_seq = -1
+        self.events_pending = asyncio.Event()
+        self.stopped = self.loop.create_future()
+
+    def publish(self, message):
+        for writer in tuple(self.workers):
+            write_message(writer, message)
+
+    def publish_events(self):
+        events = self.canvas.get_events_since(self.published_seq)
+        if events is None:
+            _log.warning("Canvas events were dropped from the history before being published")
+            self.published_seq = self.canvas.seq
+            return
+        if not events:
+            return
+        self.published_seq = events[-1][0]
+        user_count = len(self.canvas.users)
+        new_users = self.canvas.users[self.published_users:user_count]
+        marks = self.writer.get_durable_marks(self.published_mark_seq)
+        if marks:
+            self.published_mark_seq = marks[-1][1]
+        self.publish(("events", events, self.published_users, new_users, marks))
+        self.published_users = user_count
+
+    async def run_publisher(self):
+        while True:
+            await self.events_pending.wait()
+            # give events from the same moment a chance to go out together
+            await asyncio.sleep(BROADCAST_INTERVAL)
+            self.events_pending.clear()
+            self.publish_events()
+
+    async def handle_worker(self, reader, writer):
+        # everything published after this reaches the worker in order, so it doesn't miss anything
+        write_message(writer, (
+            "hello", self.canvas.epoch, self.published_seq,
+            self.canvas.users[:self.published_users], self.writer.get_durable_marks()
+        ))
+        self.workers.add(writer)
+        try:
+            while True:
+                kind, *args = await read_message(reader)
+                # the worker already checked the change is allowed
+                if kind == "place":
+                    self.canvas.place_pixel(*args)
+                elif kind == "clear":
+                    self.canvas.clear_canvas(*args)
+                elif kind == "clear_user":
+                    await self.loop.run_in_executor(self.executor, self.canvas.clear_user, *args)
+                elif kind == "ban":
+                    self.publish(("banned", *args))
+                    continue
+                self.events_pending.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+
+    async def run(self):
+        async with await asyncio.start_unix_server(self.handle_worker, self.path):
+            self.loop.create_task(self.run_publisher())
+            self.loop.create_task(self.writer.run(self.executor))
+            self.loop.create_task(self.canvas.run_checkpointer(self.executor))
+            context = multiprocessing.get_context("spawn")
+            for _ in range(self.worker_count):
+                process = context.Process(target=run_worker, args=(self.path, self.shared_path), daemon=True)
+                process.start()
+                self.processes.append(process)
+            _log.info(f"Started {self.worker_count} workers")
+            await self.stopped
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        os.unlink(self.path)
+
+    def stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
 
 
 class Server:
     DEFAULT_COOLDOWN = 0
 
-    def __init__(self):
+    def __init__(self, broker_path=None, shared_path=None):
+        """
+        on its own the server owns the canvas. with a broker_path it's one of several worker processes,
+        reading the canvas the primary shares at shared_path and sending it changes to make.
+        cooldowns and rate limits are only enforced within the process
+        """
         self.cooldown = self.DEFAULT_COOLDOWN
         self.executor = ThreadPoolExecutor()
         self.loop = asyncio.get_event_loop()
-        self.canvas = Canvas()
+        self.db_executor = DatabaseExecutor(self.loop, DB_EXECUTOR_WORKERS, DB_EXECUTOR_QUEUE)
+        if broker_path is None:
+            self.writer = PlacementWriter(self.loop)
+            self.canvas = Canvas(self.writer, shared_path)
+            self.pubsub = LocalPubSub(self, self.canvas)
+        else:
+            self.writer = None
+            self.canvas = CanvasReplica(shared_path)
+            self.pubsub = UnixPubSub(self, self.canvas, broker_path)
         self.connections = {}
-        self.user_lock = threading.Lock()
+        # authenticated connections of each user, by user id
+        self.user_connections: dict[int, set[WebsocketWrapper]] = {}
+        # sha256 of each recently seen token, with when it expires and the future of its user
+        self.token_cache: dict[bytes, tuple[float, asyncio.Future]] = {}
         self.commands = {
-            # "PLACE": self.handle_place,
-            # "AUTH": self.handle_authentication,
-            # "CLEAR": self.handle_clear,
-            # "BAN": self.handle_ban,
+            "PLACE": self.handle_place,
+            "AUTH": self.handle_authentication,
+            "CLEAR": self.handle_clear,
+            "BAN": self.handle_ban,
             "PING": self.handle_ping,
+            "WHO": self.handle_who,
+            "USERS": self.handle_users,
+            "CANVAS": self.handle_canvas,
+            "SEQ": self.handle_seq,
+            "SINCE": self.handle_since,
+            "BINARY": self.handle_binary,
             # "SETCOOLDOWN": self.handle_set_cooldown,
-            # "CLEARUSER": self.handle_clear_user,
+            "CLEARUSER": self.handle_clear_user,
         }
         self.last_place = None
+        self.stopped = self.loop.create_future()
+        # seq of the last canvas event sent to everyone, and size of the user table at that point
+        self.broadcast_seq = 0
+        self.broadcast_users = len(self.canvas.users)
+        self.events_pending = asyncio.Event()
 
     async def send_canvas_info(self, ws):
         """event loop safe"""
-        canvas, users = await self.loop.run_in_executor(self.executor, self.canvas.get_canvas_info)
+        canvas = await self.loop.run_in_executor(self.executor, self.canvas.get_canvas_info)
         await ws.send(canvas)
-        await ws.send("USERS "+users)
 
-    def get_user(self, token) -> Union[str, UserModel]:
+    async def send_owner_info(self, ws):
+        """event loop safe"""
+        user_table, owners = await self.loop.run_in_executor(self.executor, self.canvas.get_owner_info)
+        await ws.send(user_table)
+        await ws.send(owners)
+
+    def get_user(self, token) -> Union[str, User]:
         """not event loop safe"""
-        # not so sure about the thread-safety of calling _get_user
-        self.user_lock.acquire()
         user = _get_user(token)
-        self.user_lock.release()
         if user is None:
             return "AUTHENTICATION FAILED"
-        return user
+        return User(user)
+
+    @staticmethod
+    def get_user_by_name(username) -> User:
+        """not event loop safe"""
+        return User(UserModel.objects.get(username=username.lower()))
+
+    @staticmethod
+    def ban_user(user_id):
+        """not event loop safe"""
+        BannedUser.objects.create(user_id=user_id, timestamp=time())
+
+    async def authenticate(self, token) -> Union[str, User]:
+        """
+        event loop safe
+        tokens are verified in parallel, and the same token is only verified once while it's cached
+        """
+        now = time()
+        key = hashlib.sha256(token.encode()).digest()
+        cached = self.token_cache.get(key)
+        if cached is not None and cached[0] > now:
+            # shielded, so one connection going away doesn't cancel the lookup for everyone sharing it
+            return await asyncio.shield(cached[1])
+
+        if len(self.token_cache) >= TOKEN_CACHE_SIZE:
+            self.token_cache = {key: cached for key, cached in self.token_cache.items() if cached[0] > now}
+        future = self.db_executor.submit(self.get_user, token)
+        self.token_cache[key] = (now + TOKEN_CACHE_TTL, future)
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            self.token_cache.pop(key, None)
+            raise
+
+    def schedule_broadcast(self):
+        self.events_pending.set()
+
+    def broadcast_events(self):
+        """sends new canvas events to everyone in the order they happened, as one message"""
+        events = self.canvas.get_events_since(self.broadcast_seq)
+        if events is None:
+            _log.warning("Canvas events were dropped from the history before being broadcast")
+            self.broadcast_seq = self.canvas.seq
+            return
+        if not events:
+            return
 
-    async def send_all(self, message, exclude=None):
-        if exclude is None:
-            exclude = []
+        first_seq = self.broadcast_seq + 1
+        self.broadcast_seq += len(events)
 
-        _log.info(f"Sending {message} to all")
+        # binary clients refer to users by index, so let them know about any new ones first
+        user_count = len(self.canvas.users)
+        new_users = None
+        if user_count > self.broadcast_users:
+            new_users = f"USERADD {self.broadcast_users} " + " ".join(self.canvas.users[self.broadcast_users:user_count])
+            self.broadcast_users = user_count
 
-        for ws in tuple(filter(lambda ws: ws.id not in exclude, self.connections.values())):
-            await ws.send(message, log=False)
+        message = None
+        frame = None
+        for ws in tuple(self.connections.values()):
+            if ws.is_binary:
+                if frame is None:
+                    frame = struct.pack("<BxxxI", EVENTS_FRAME, first_seq) + b"".join(event[2] for event in events)
+                if new_users is not None:
+                    ws.enqueue(new_users)
+                ws.enqueue(frame)
+            else:
+                if message is None:
+                    message = "\n".join(event[1] for event in events)
+                ws.enqueue(message)
+
+    async def run_broadcaster(self):
+        while True:
+            await self.events_pending.wait()
+            # give events from the same moment a chance to go out together
+            await asyncio.sleep(BROADCAST_INTERVAL)
+            self.events_pending.clear()
+            self.broadcast_events()
 
     def get_same_users(self, user_id):
         """event loop safe"""
-        return tuple(filter(lambda other_ws: other_ws.user.is_authenticated and
-                                       other_ws.user.id == user_id,
-                      self.connections.values()))
+        return tuple(self.user_connections.get(user_id, ()))
 
     # Events
     # All events are event loop safe
@@ -262,19 +985,15 @@ class Server:
             return "ALREADY AUTHENTICATED"
         if len(args) < 1:
             return "INVALID"
-        result = await self.loop.run_in_executor(self.executor, self.get_user, args[0])
+        result = await self.authenticate(args[0])
         if type(result) == str:
             return result
         elif result.banned:
             return "FORBIDDEN"
 
-        connected_elsewhere = False
-        for other_ws in self.get_same_users(result.id):
-            connected_elsewhere = True
-            ws.user = other_ws.user
-            break
-        if not connected_elsewhere:
-            ws.user = User(result)
+        same_users = self.user_connections.setdefault(result.id, set())
+        ws.user = next(iter(same_users)).user if same_users else result
+        same_users.add(ws)
 
         await ws.send("AUTHENTICATION SUCCESS")
         if time() - ws.user.last_placement < self.cooldown:
@@ -294,11 +1013,8 @@ class Server:
             return "INVALID"
         if not (0 <= x1 < CANVAS_WIDTH and 0 <= x2 < CANVAS_WIDTH) or not (0 <= y1 < CANVAS_HEIGHT and 0 <= y2 < CANVAS_HEIGHT):
             return "INVALID"
-        await self.loop.run_in_executor(self.executor, self.canvas.clear_canvas, x1, y1, x2, y2)
+        await self.pubsub.clear_canvas(x1, y1, x2, y2)
         print(f"{ws.user.name} cleared from ({x1}, {y1}) to ({x2}, {y2})")
-        event = f"CLEAR {x1} {y1} {x2} {y2}"
-        await ws.send(event)  # prioritize user that sent the command
-        await self.send_all(event, [ws.id])
 
     async def handle_place(self, ws, args):
         if not ws.user.is_authenticated or not ws.user.can_place(self.cooldown):
@@ -311,41 +1027,113 @@ class Server:
             return "INVALID"
         if c > 39 or not 0 <= x < CANVAS_WIDTH or not 0 <= y < CANVAS_HEIGHT:
             return "INVALID"
-        last_placement = await self.loop.run_in_executor(self.executor, self.canvas.get_last_pixel, x, y)
-        if last_placement and last_placement["user"] == ws.user.name and last_placement["color"] == c:
+        owner, color = self.canvas.get_last_pixel(x, y)
+        if owner == ws.user.name and color == c:
             return "FORBIDDEN"
-        await self.loop.run_in_executor(self.executor, self.canvas.place_pixel, ws.user, x, y, c)
-        await self.loop.run_in_executor(self.executor, ws.user.on_place)
+        ws.user.on_place()
+        await self.pubsub.place_pixel(ws.user.id, ws.user.name, x, y, c)
         print(f"{ws.user.name} placed {c} at ({x}, {y})")
-        event = f"PLACE {ws.user.name} {x} {y} {c}"
         self.last_place = ws.user.id
-        await ws.send(event)
         if self.cooldown > 0:
             for other_ws in self.get_same_users(ws.user.id):
                 await other_ws.send(f"COOLDOWN {int((ws.user.last_placement+self.cooldown)*1000)}")
-        await self.send_all(event, [ws.id])
 
     async def handle_ban(self, ws, args):
         if not ws.user.is_authenticated or not ws.user.can_ban:
             return "FORBIDDEN"
         if len(args) < 1:
             return "INVALID"
+        # named functions rather than partials of manager methods, so their timings are told apart
         try:
-            user = await self.loop.run_in_executor(self.executor, partial(UserModel.objects.get, twitch_name=args[0].lower()))
+            user = await self.db_executor.submit(self.get_user_by_name, args[0])
         except UserModel.DoesNotExist:
             return "INVALID"
         if user.banned:
             return
         if user.can_mod:
             return "FORBIDDEN"
-        user.banned = True
-        await self.loop.run_in_executor(self.executor, user.save)
-        for ws in self.get_same_users(user.id):
+        await self.db_executor.submit(self.ban_user, user.id)
+        await self.pubsub.ban(user.id)
+
+    async def on_banned(self, user_id):
+        # cached users aren't necessarily connected right now
+        for _, future in tuple(self.token_cache.values()):
+            if not future.done() or future.cancelled() or future.exception() is not None:
+                continue
+            user = future.result()
+            if isinstance(user, User) and user.id == user_id:
+                user.banned = True
+        for ws in self.get_same_users(user_id):
+            ws.user.banned = True
             await ws.send("BANNED")
 
     async def handle_ping(self, ws, args):
         await ws.send("PONG")
 
+    async def handle_who(self, ws, args):
+        if len(args) != 2:
+            return "INVALID"
+        try:
+            x, y = tuple(map(int, args))
+        except ValueError:
+            return "INVALID"
+        if not 0 <= x < CANVAS_WIDTH or not 0 <= y < CANVAS_HEIGHT:
+            return "INVALID"
+        return f"WHO {x} {y} {self.canvas.get_owner(x, y)}"
+
+    async def handle_canvas(self, ws, args):
+        # clients normally load the canvas as tiles over http, see place.views.canvas_tile
+        await self.send_canvas_info(ws)
+
+    async def handle_seq(self, ws, args):
+        # the client loaded the canvas as tiles, each complete up to the placement id it came with.
+        # send everything after the oldest of them to apply on top, including placements that
+        # are still waiting to be written
+        if len(args) != 1:
+            return "INVALID"
+        try:
+            placement_id = int(args[0])
+        except ValueError:
+            return "INVALID"
+        events = self.canvas.get_events_since_placement(
+            placement_id, self.canvas.get_durable_marks(), self.broadcast_seq
+        )
+        if events is None:
+            await ws.send("RESYNC")
+            await self.send_canvas_info(ws)
+        else:
+            # tells the client to drop the events it got before these, which they already cover
+            await ws.send("\n".join(["REPLAY"] + [event[1] for event in events]), log=False)
+        return f"SEQ {self.canvas.epoch} {self.broadcast_seq}"
+
+    async def handle_since(self, ws, args):
+        if len(args) != 2:
+            return "INVALID"
+        try:
+            epoch, seq = tuple(map(int, args))
+        except ValueError:
+            return "INVALID"
+        events = None
+        if epoch == self.canvas.epoch:
+            events = self.canvas.get_events_since(seq, self.broadcast_seq)
+        if events is None:
+            # missed too much (or the server restarted), so start over from a full snapshot.
+            # events broadcast while it's fetched are already part of it and are harmless to apply first
+            await ws.send("RESYNC")
+            await self.send_canvas_info(ws)
+        elif events:
+            await ws.send("\n".join(event[1] for event in events), log=False)
+        return f"SEQ {self.canvas.epoch} {self.broadcast_seq}"
+
+    async def handle_binary(self, ws, args):
+        # the table has to reach the client before any event referring to it by index
+        await ws.send(self.canvas.get_user_table(), log=False)
+        ws.is_binary = True
+
+    async def handle_users(self, ws, args):
+        # the full owner map is opt-in, most clients only need a few pixels through WHO
+        await self.send_owner_info(ws)
+
     async def handle_set_cooldown(self, ws, args):
         if not ws.user.is_authenticated or not ws.user.can_set_cooldown:
             return "FORBIDDEN"
@@ -355,26 +1143,43 @@ class Server:
             self.cooldown = int(args[0])
         except ValueError:
             return "INVALID"
-        for ws in tuple(self.connections.values()):
-            if (now := time()) - ws.user.last_placement < self.cooldown:
-                await self.send_all(f"COOLDOWN {ws.user.last_placement + self.cooldown}")
+        now = time()
+        for connections in tuple(self.user_connections.values()):
+            user = next(iter(connections)).user
+            if now - user.last_placement < self.cooldown:
+                for other_ws in tuple(connections):
+                    await other_ws.send(f"COOLDOWN {int((user.last_placement+self.cooldown)*1000)}")
 
     async def handle_clear_user(self, ws, args):
         if not ws.user.is_authenticated or not ws.user.can_clear_user:
             return "FORBIDDEN"
         if len(args) < 1:
             return "INVALID"
-        await self.loop.run_in_executor(self.executor, self.canvas.clear_user, args[0])
-        if self.canvas.canvas_cache is None:
-            # Not using websockets.broadcast because it does not use fragmenting and this is sizeable data
-            canvas, users = await self.loop.run_in_executor(self.executor, self.canvas.get_canvas_info)
-            for ws in tuple(self.connections.values()):
-                await ws.send(canvas)
-                await ws.send(users)
+        await self.pubsub.clear_user(args[0].lower())
 
     # Event functionality
 
+    async def handle_binary_command(self, ws, command):
+        if len(command) == 6 and command[0] == PLACE_COMMAND:
+            _, x, y, c = struct.unpack("<BHHB", command)
+            result = await self.handle_place(ws, (x, y, c))
+        else:
+            result = "INVALID"
+        if result is not None:
+            await ws.send(result)
+
+    def is_rate_limited(self, ws):
+        """event loop safe"""
+        if not ws.rate_limiter.take():
+            return True
+        return ws.user.is_authenticated and not ws.user.rate_limiter.take()
+
     async def handle_command(self, ws, command):
+        # before anything else, so flooding can't tie up the executor or the database
+        if self.is_rate_limited(ws):
+            return await ws.send("RATE LIMITED")
+        if isinstance(command, bytes):
+            return await self.handle_binary_command(ws, command)
         if command.lower() != "ping":
             _log.info(f"{ws.id}: {command}")
         command = command.split()
@@ -382,7 +1187,10 @@ class Server:
             return await ws.send("INVALID")
         command, args = command[0], command[1:]
         if command.upper() in self.commands:
-            result = await self.commands[command.upper()](ws, args)
+            try:
+                result = await self.commands[command.upper()](ws, args)
+            except ExecutorBusy:
+                result = "BUSY"
             if result is not None:
                 await ws.send(result)
             return
@@ -391,8 +1199,8 @@ class Server:
     async def handler(self, ws):
         self.connections[ws.id] = (ws := WebsocketWrapper(ws, AnonymousUser()))
         _log.info(f"Opened connection with {ws.id}")
+        writer = asyncio.create_task(ws.write_messages())
         try:
-            await self.send_canvas_info(ws)
             while True:
                 command = await ws.recv(do_check=ws.user.is_authenticated and self.last_place == ws.user.id)
                 if command is None:
@@ -405,13 +1213,70 @@ class Server:
         finally:
             _log.info(f"Closed connection with {ws.id}")
             del self.connections[ws.id]
+            if ws.user.is_authenticated:
+                same_users = self.user_connections[ws.user.id]
+                same_users.discard(ws)
+                if not same_users:
+                    del self.user_connections[ws.user.id]
+            writer.cancel()
 
     async def run(self):
-        async with websockets.serve(self.handler, os.getenv("SERVER_HOST"), os.getenv("SERVER_PORT")):
+        await self.pubsub.connect()
+        self.broadcast_seq = self.canvas.seq
+        self.broadcast_users = len(self.canvas.users)
+        # workers all listen on the same port, and the kernel spreads connections between them
+        async with websockets.serve(
+            self.handler, os.getenv("SERVER_HOST"), os.getenv("SERVER_PORT"), reuse_port=self.writer is None
+        ):
             _log.info("Server up!")
-            await asyncio.Future()  # run forever
+            self.loop.create_task(self.db_executor.run_stats_logger())
+            if self.writer is None:
+                self.loop.create_task(self.pubsub.run())
+            else:
+                self.loop.create_task(self.run_broadcaster())
+                self.loop.create_task(self.writer.run(self.executor))
+                self.loop.create_task(self.canvas.run_checkpointer(self.executor))
+            await self.stopped
+
+    def stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+
+def add_signal_handlers(loop, stop):
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop)
+        except NotImplementedError:  # windows
+            pass
 
 
-if __name__ == "__main__":
-    server = Server()
+def run_worker(broker_path, shared_path):
+    server = Server(broker_path, shared_path)
+    add_signal_handlers(server.loop, server.stop)
     server.loop.run_until_complete(server.run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of websocket server processes. each worker keeps its own placement cooldowns "
+             "and rate limits, so a user connected to several workers at once gets the limits of each"
+    )
+    args = parser.parse_args()
+
+    # other processes on this box can map the canvas read only from CANVAS_SHARED_PATH
+    shared_path = os.getenv("CANVAS_SHARED_PATH") or None
+    if args.workers > 1:
+        if shared_path is None:
+            shared_path = os.path.join(tempfile.gettempdir(), f"place-canvas-{os.getpid()}")
+        server = Primary(args.workers, os.path.join(tempfile.gettempdir(), f"place-{os.getpid()}.sock"), shared_path)
+    else:
+        server = Server(shared_path=shared_path)
+    add_signal_handlers(server.loop, server.stop)
+    try:
+        server.loop.run_until_complete(server.run())
+    finally:
+        # don't lose placements that were acknowledged but not written yet, and make the next startup quick
+        run_with_connection(server.canvas.checkpoint)
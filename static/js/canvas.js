@@ -49,6 +49,21 @@ const errorLabel = document.getElementById("error-label");
 const canvasWidth = 750;
 const canvasHeight = 750;
 
+const tileSize = 50;
+
+// binary frame opcodes
+const canvasFrame = 0;
+const ownersFrame = 1;
+const eventsFrame = 2;
+
+// canvas events inside an events frame
+const placeEvent = 0;
+const clearEvent = 1;
+const eraseEvent = 2;
+
+// binary command opcodes
+const placeCommand = 0;
+
 // states
 
 var ws = null;
@@ -58,14 +73,21 @@ var pressed = false;
 var mousePos = [0, 0];
 var currentZoom = null;
 var currentZoomAmount = 1;
-var userList = [];
+var userTable = [""];
+var ownerView = null;
+var ownerOverrides = new Map();
+var ownerRequestTimeout = null;
+var pendingEvents = null;
+var canvasEpoch = null;
+var lastSeq = null;
+var reconnectDelay = 1000;
+var pingTimeout = null;
 var onCooldown = false;
 var scrollAmount = 0;
 
 // canvas drawing
 
-function loadCanvas(data) {
-    const view = new Uint8Array(data);
+function drawPixels(view, x, y, width, height) {
     const pixels = new Uint8ClampedArray(view.length*4);
     for (var i=0; i<view.length; i++) {
         const color = colors[view[i]];
@@ -75,20 +97,147 @@ function loadCanvas(data) {
         pixels[index+2] = color[2];
         pixels[index+3] = 255;
     }
-    const imageData = new ImageData(pixels, canvasWidth, canvasHeight);
-    ctx.putImageData(imageData, 0, 0);
+    const imageData = new ImageData(pixels, width, height);
+    ctx.putImageData(imageData, x, y);
+}
+
+function loadCanvas(data) {
+    // the frame is up to date with every event sent before it
+    pendingEvents = null;
+    drawPixels(new Uint8Array(data, 1), 0, 0, canvasWidth, canvasHeight);
+}
+
+function loadTile(x, y) {
+    // revalidated against the tile's etag, so unchanged tiles come from the browser cache.
+    // resolves to the placement id the tile is complete up to
+    return fetch("/place/tiles/"+x+"/"+y+"/", {cache: "no-cache"}).then(response => {
+        if (!response.ok) {throw new Error("Failed to load tile "+x+", "+y);}
+        const version = parseInt(response.headers.get("X-Placement-Version"));
+        return new Response(response.body.pipeThrough(new DecompressionStream("deflate"))).arrayBuffer().then(data => {
+            drawPixels(new Uint8Array(data), x*tileSize, y*tileSize, tileSize, tileSize);
+            return version;
+        });
+    });
+}
+
+function replayPendingEvents() {
+    const events = pendingEvents;
+    pendingEvents = null;
+    if (events !== null) {
+        events.forEach(handleMessage);
+    }
+}
+
+function loadTiles() {
+    // hold on to canvas events until every tile is drawn and the server replied
+    // with what happened since the oldest of them, then apply those on top
+    pendingEvents = [];
+    const tiles = [];
+    for (var y=0; y<canvasHeight/tileSize; y++) {
+        for (var x=0; x<canvasWidth/tileSize; x++) {
+            tiles.push(loadTile(x, y));
+        }
+    }
+    Promise.all(tiles).then(versions => {
+        if (ws !== null) {
+            ws.send("SEQ "+Math.min(...versions));
+        }
+    }).catch(error => {
+        console.log(error);
+        // too old for any history, so the server sends the full canvas instead
+        if (ws !== null) {
+            ws.send("SEQ 0");
+        }
+    });
+}
+
+function loadOwners(data) {
+    // owner indices are only looked up when needed rather than decoded up front
+    const itemSize = new Uint8Array(data, 1, 1)[0];
+    ownerView = itemSize === 2 ? new Uint16Array(data, 4) : new Uint32Array(data, 4);
+    ownerOverrides.clear();
+    updatePlaceOutline();
+}
+
+function getOwner(i) {
+    if (ownerOverrides.has(i)) {return ownerOverrides.get(i);}
+    if (ownerView === null) {
+        requestOwner(i);
+        return undefined;
+    }
+    return userTable[ownerView[i]];
+}
+
+function requestOwner(i) {
+    // only ask once the outline has settled on a pixel
+    clearTimeout(ownerRequestTimeout);
+    ownerRequestTimeout = setTimeout(() => {
+        if (ws !== null) {
+            ws.send("WHO "+(i % canvasWidth)+" "+Math.floor(i / canvasWidth));
+        }
+    }, 100);
 }
 
 function placePixel(user, x, y, c) {
     ctx.fillStyle = hexColors[c];
     ctx.fillRect(x, y, 1, 1);
-    userList[x + canvasWidth * y] = user;
+    ownerOverrides.set(x + canvasWidth * y, user);
     updatePlaceOutline();
 }
 
 function clearCanvas(x1, y1, x2, y2) {
     ctx.fillStyle = hexColors[0];
     ctx.fillRect(x1, y1, x2-x1+1, y2-y1+1);
+    for (var y=y1; y<=y2; y++) {
+        for (var x=x1; x<=x2; x++) {
+            ownerOverrides.set(x + canvasWidth * y, "");
+        }
+    }
+    updatePlaceOutline();
+}
+
+function erasePixels(indices) {
+    ctx.fillStyle = hexColors[0];
+    for (const i of indices) {
+        ctx.fillRect(i % canvasWidth, Math.floor(i / canvasWidth), 1, 1);
+        ownerOverrides.set(i, "");
+    }
+    updatePlaceOutline();
+}
+
+function loadEvents(data) {
+    const view = new DataView(data);
+    var seq = view.getUint32(4, true);
+    var offset = 8;
+    while (offset < view.byteLength) {
+        const type = view.getUint8(offset);
+        if (type === placeEvent) {
+            const color = view.getUint8(offset+1);
+            const x = view.getUint16(offset+2, true);
+            const y = view.getUint16(offset+4, true);
+            const user = userTable[view.getUint32(offset+6, true)];
+            doWhenTrue(checkIsAuthenticated, () => {placePixel(user, x, y, color);});
+            offset += 10;
+        } else if (type === clearEvent) {
+            clearCanvas(
+                view.getUint16(offset+1, true), view.getUint16(offset+3, true),
+                view.getUint16(offset+5, true), view.getUint16(offset+7, true)
+            );
+            offset += 9;
+        } else if (type === eraseEvent) {
+            const count = view.getUint32(offset+1, true);
+            const indices = [];
+            for (var i=0; i<count; i++) {
+                indices.push(view.getUint32(offset+5+i*4, true));
+            }
+            erasePixels(indices);
+            offset += 5 + count*4;
+        } else {
+            console.log("Unknown canvas event "+type);
+            return;
+        }
+        lastSeq = seq++;
+    }
 }
 
 function getPlacePos(canvasRect = null) {
@@ -149,7 +298,7 @@ function updatePlaceOutline() {
         placeOutline.style.height = currentZoomAmount+"px";
         placeOutline.style.borderWidth = (currentZoomAmount/8)+"px";
     }
-    const user = userList[placeX+placeY*canvasWidth];
+    const user = getOwner(placeX+placeY*canvasWidth);
     if (!(user === undefined)) {userLabel.innerHTML = "User: "+user;}
 }
 
@@ -315,7 +464,12 @@ for (const colorOption of colorOptions) {
 function onPlace(event = null) {
     if (!isAuthenticated || currentZoomAmount < 8 || onCooldown) {return;}
     const pos = getPlacePos();
-    ws.send("PLACE "+Math.round(pos[0])+" "+Math.round(pos[1])+" "+currentlySelectedColor);
+    const command = new DataView(new ArrayBuffer(6));
+    command.setUint8(0, placeCommand);
+    command.setUint16(1, Math.round(pos[0]), true);
+    command.setUint16(3, Math.round(pos[1]), true);
+    command.setUint8(5, currentlySelectedColor);
+    ws.send(command.buffer);
 }
 
 if (placeButton) {
@@ -383,46 +537,106 @@ function popupError(message, timer = null) {
 }
 
 function pingServer() {
+    clearTimeout(pingTimeout);
     if (ws !== null) {
         ws.send("PING");
-        setTimeout(pingServer, 1000*60*5);
+        pingTimeout = setTimeout(pingServer, 1000*60*5);
     }
 }
 
 function onOpen(event, authdata) {
+    reconnectDelay = 1000;
+    errorBox.setAttribute("hidden", "");
     if (authdata.token) {
         ws.send("AUTH "+authdata.token);
     }
+    ws.send("BINARY");
+    if (canvasEpoch === null) {
+        loadTiles();
+    } else {
+        // only ask for what was missed while disconnected
+        ws.send("SINCE "+canvasEpoch+" "+lastSeq);
+    }
     pingServer();
 }
 
+function isCanvasEvent(data) {
+    if (data instanceof ArrayBuffer) {
+        return new Uint8Array(data, 0, 1)[0] === eventsFrame;
+    }
+    return data.startsWith("PLACE") || data.startsWith("CLEAR") || data.startsWith("ERASE");
+}
+
 function onMessage(event) {
     console.log(event.data);
-    if (event.data.type === "") {
-        event.data.arrayBuffer().then(data => {
+    if (typeof event.data === "string") {
+        // canvas events come batched together, one per line
+        event.data.split("\n").forEach(handleMessage);
+    } else {
+        handleMessage(event.data);
+    }
+}
+
+function handleMessage(data) {
+    if (data === "REPLAY") {
+        // what follows covers every event received while loading the tiles
+        pendingEvents = [];
+    } else if (pendingEvents !== null && isCanvasEvent(data)) {
+        pendingEvents.push(data);
+    } else if (data instanceof ArrayBuffer) {
+        const opcode = new Uint8Array(data, 0, 1)[0];
+        if (opcode === canvasFrame) {
             loadCanvas(data);
-        });
-    } else if (event.data.startsWith("PLACE")) {
-        const match = event.data.match(/PLACE (\w*) ([0-9]+) ([0-9]+) ([0-9]+)/);
-		const user = match[1];
-		const x = parseInt(match[2]);
-		const y = parseInt(match[3]);
-		const color = parseInt(match[4]);
+        } else if (opcode === ownersFrame) {
+            loadOwners(data);
+        } else if (opcode === eventsFrame) {
+            loadEvents(data);
+        }
+    } else if (data.startsWith("PLACE")) {
+        const match = data.match(/PLACE ([0-9]+) (\w*) ([0-9]+) ([0-9]+) ([0-9]+)/);
+        lastSeq = parseInt(match[1]);
+		const user = match[2];
+		const x = parseInt(match[3]);
+		const y = parseInt(match[4]);
+		const color = parseInt(match[5]);
 		doWhenTrue(checkIsAuthenticated, () => {placePixel(user, x, y, color);});
-    } else if (event.data.startsWith("CLEAR")) {
-        const match = event.data.match(/CLEAR ([0-9]+) ([0-9]+) ([0-9]+) ([0-9]+)/);
-        clearCanvas(parseInt(match[1]), parseInt(match[2]), parseInt(match[3]), parseInt(match[4]));
-    } else if (event.data.startsWith("USERS")) {
-        userList = event.data.slice(6).split(' ');
+    } else if (data.startsWith("CLEAR")) {
+        const match = data.match(/CLEAR ([0-9]+) ([0-9]+) ([0-9]+) ([0-9]+) ([0-9]+)/);
+        lastSeq = parseInt(match[1]);
+        clearCanvas(parseInt(match[2]), parseInt(match[3]), parseInt(match[4]), parseInt(match[5]));
+    } else if (data.startsWith("ERASE")) {
+        const values = data.slice(6).split(' ').map((i) => parseInt(i));
+        lastSeq = values[0];
+        erasePixels(values.slice(1));
+    } else if (data.startsWith("SEQ")) {
+        const match = data.match(/SEQ ([0-9]+) ([0-9]+)/);
+        canvasEpoch = parseInt(match[1]);
+        lastSeq = parseInt(match[2]);
+        replayPendingEvents();
+    } else if (data === "RESYNC") {
+        // a full canvas follows, so anything known about owners is out of date
+        ownerView = null;
+        ownerOverrides.clear();
+    } else if (data.startsWith("WHO")) {
+        const match = data.match(/WHO ([0-9]+) ([0-9]+) ?(\w*)/);
+        ownerOverrides.set(parseInt(match[1]) + canvasWidth * parseInt(match[2]), match[3]);
         updatePlaceOutline();
-    } else if (event.data.startsWith("COOLDOWN")) {
-        const match = event.data.match(/COOLDOWN ([0-9]+)/);
+    } else if (data.startsWith("USERTABLE")) {
+        userTable = [""].concat(data.slice(10).split(' '));
+    } else if (data.startsWith("USERADD")) {
+        const values = data.slice(8).split(' ');
+        const start = parseInt(values[0]);
+        for (var i=1; i<values.length; i++) {
+            userTable[start+i-1] = values[i];
+        }
+    } else if (data.startsWith("COOLDOWN")) {
+        const match = data.match(/COOLDOWN ([0-9]+)/);
 		const cooldown = parseInt(match[1]);
 		doWhenTrue(checkIsAuthenticated, () => {startPlaceTimer(cooldown);});
-    } else if (event.data === "AUTHENTICATION SUCCESS") {
+    } else if (data === "AUTHENTICATION SUCCESS") {
         isAuthenticated = true;
         setColor(0);
-    } else if (event.data === "BANNED") {
+    } else if (data === "BANNED") {
         isAuthenticated = false;
         placeLabel.innerHTML = "Banned";
         placeButton.classList.add("place-button-cooldown");
@@ -432,11 +646,17 @@ function onMessage(event) {
     }
 }
 
+function reconnect() {
+    setTimeout(connect, reconnectDelay);
+    reconnectDelay = Math.min(reconnectDelay*2, 1000*30);
+}
+
 function onClose(event) {
     console.log("Connection to webserver closed...");
-    popupError("Websocket connection closed... try refreshing the website later.");
+    popupError("Websocket connection closed... reconnecting.");
     ws = null;
     isAuthenticated = false;
+    reconnect();
 }
 
 function connect() {
@@ -444,11 +664,14 @@ function connect() {
         return response.json();
     }).then(authdata => {
         ws = new WebSocket("wss://bot.sheppsu.me/ws/");
-        ws.binaryType = "blob";
+        ws.binaryType = "arraybuffer";
         ws.onopen = (event) => {onOpen(event, authdata);};
         ws.onmessage = onMessage;
         ws.onerror = (event) => {console.log("Websocket error: ", event);}
         ws.onclose = onClose;
+    }).catch(error => {
+        console.log(error);
+        reconnect();
     });
 }
 